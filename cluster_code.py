@@ -5,18 +5,38 @@ data using clustering methods and fits models to datasets using curve fitting
 """
 
 # Import the neccessary libraries
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np                     # 
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')                  # Render figures to files
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
 
-import statsmodels.api as sm                     # Statistics
-from sklearn.cluster import KMeans               # Clustering 
+from scipy import stats                          # Statistics
+from sklearn.cluster import MiniBatchKMeans      # Clustering
 from scipy.optimize import curve_fit             # Fitting
 
-from cluster_tools import map_corr, scaler     # Tools to support clustering
+from cluster_tools import scaler     # Tools to support clustering
 from errors import error_prop     # error functions from errors.py
 
+# Function to build a file name for a saved figure
+def figure_path(name):
+    """
+    Return the png file name used to save the figure for `name`.
+    
+    Example:
+    
+        figure_path('CO2 emissions (kt)')  # 'out_CO2_emissions_kt.png'
+    
+    """
+    return f"out_{re.sub(r'[^0-9A-Za-z]+', '_', name).strip('_')}.png"
+
 # Defining a function that loads, clean and return two dataframes
 def read_data(filename):
     """
@@ -28,43 +48,42 @@ def read_data(filename):
         df1, df2 = read_data('mydata.csv')
     
     """
-    # Load the data
-    wdi_data = pd.read_csv(filename)
-    
-    # Clean data by replace non-number with pd.NA
-    wdi_data = wdi_data.replace('..', pd.NA)
+    # Year Columns, read as float32, ample for 3-4 significant digits
+    year_cols = ['1980', '1985', '1990', '1995',
+                 '2000', '2005', '2010', '2015', '2020']
+
+    # Load the data, parsing the '..' placeholders as missing values
+    wdi_data = pd.read_csv(filename, na_values=['..'],
+                           dtype={year: np.float32 for year in year_cols})
     
+    # Remove Meta Data Rows
+    wdi_data.drop(wdi_data.index[1519:], inplace=True)
+
+    # Drop Un-needed Column
+    wdi_data.drop(["Country Code", "Series Code"], axis=1, inplace=True)
+
     # Handle Missing Values
-    wdi_data = wdi_data.fillna(method='ffill').fillna(method='bfill')
+    wdi_data = wdi_data.ffill(axis=0)
+    wdi_data.bfill(axis=0, inplace=True)
 
     # Drop Duplicates
     wdi_data = wdi_data.drop_duplicates()
 
-    # Remove Meta Data Rows
-    wdi_data.drop(wdi_data.index[1519:], inplace=True)
+    # Transpose the Data to have indicators as columns
+    # Keep the first row of each (Series, Country) pair, as pivot_table did
+    wdi_unique = wdi_data[~wdi_data.duplicated(['Series Name', 'Country Name'])]
+    n_rows = len(wdi_unique)
 
-    # Drop Un-needed Column
-    wdi_data.drop(["Country Code", "Series Code"], axis=1, inplace=True)
+    # Stack the year block year-major with a single reshape
+    values = wdi_unique[year_cols].to_numpy().T.reshape(-1)
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(year_cols, n_rows),
+         np.tile(wdi_unique['Country Name'].to_numpy(), len(year_cols)),
+         np.tile(wdi_unique['Series Name'].to_numpy(), len(year_cols))],
+        names=['Year', 'Country Name', 'Series Name'])
 
-    # Convert the Year Columns to float data type
-    wdi_data[['1980', '1985', '1990', '1995', 
-              '2000', '2005', '2010', '2015', '2020']] = wdi_data[['1980', '1985', '1990', '1995', 
-              '2000', '2005', '2010', '2015', '2020']].astype(float)
-
-    # Transpose the Data to have indicators as columns 
-    # Melt the = dataframe to have 'YEAR' as a column
-    wdi_transposed = pd.melt(wdi_data,
-                             id_vars=['Series Name','Country Name'],
-                             var_name='Year',
-                             value_name='Value')
-
-    # Pivot the melted dataframe to have individual columns
-    # for each country
-    wdi_transposed = wdi_transposed.pivot_table(
-        index=['Year', 'Country Name'],
-        columns='Series Name',
-        values='Value',
-        aggfunc='first')
+    # Unstack the indicators to have individual columns
+    wdi_transposed = pd.Series(values, index=index).unstack('Series Name')
 
     # Reset index for a clean structure
     wdi_transposed.reset_index(inplace=True)
@@ -75,6 +94,12 @@ df1, df2 = read_data('cluster_data.csv')
 
 indicator_list = df1['Series Name'].unique()
 
+# Plot titles for each indicator, without the units
+indicator_titles = {ind: ind.split('(')[0] for ind in indicator_list}
+
+# Numeric columns of the indicator frame, used for correlation and clustering
+numeric_cols = df2.select_dtypes(include=np.number).columns.tolist()
+
 # Function to generate visualizations telling a visual story of the data
 def visualize(data_frame, indicators):
     """
@@ -86,42 +111,58 @@ def visualize(data_frame, indicators):
       
     """
     # Plot bar chart for top 10 countries for each indicator in 2020
-    for indicator in indicators:
-        plot_data = data_frame[data_frame['Year'] == '2020'].copy()
+    is_2020 = (data_frame['Year'] == '2020').to_numpy()
 
-        # Assign ranks based on CO2 emissions (kt)
-        plot_data.loc[:, 'Rank'] = plot_data[indicator].rank(ascending=False)
-        
-        # Select the top 10 Emitting Countries
-        plot_data = plot_data.sort_values('Rank').head(10)
+    def render(indicator):
+        # Select the top 10 Countries for the indicator
+        top = data_frame.loc[is_2020, ['Country Name', indicator]].nlargest(10, indicator)
         
-        ax = sns.barplot(x=indicator, y='Country Name', data=plot_data,
-                          order=plot_data.sort_values('Rank')['Country Name'],
-                          palette='Blues')
+        # Each worker draws on its own Figure, pyplot is not thread-safe
+        fig = Figure(dpi=100)
+        ax = fig.subplots()
+        sns.barplot(x=indicator, y='Country Name', data=top,
+                    order=top['Country Name'],
+                    palette='Blues', ax=ax)
         
-        title_text = indicator.split('(')[0]
+        title_text = indicator_titles[indicator]
         
         ax.set_title(f'Top 10 Countries: {title_text}',
                              color='#0f484f', fontsize=15, fontweight='bold')
         ax.set_xlabel(None)
         ax.set_ylabel(None)
         
-        plt.show()  
+        FigureCanvasAgg(fig).print_png(figure_path(f'top10 {indicator}'))
+
+    # Render the indicators in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(render, indicators))
         
     # Plot Line
 
 visualize(df2, indicator_list)
 
-# Correlation using the map_corr function from cluster_tools
-correlation_map = map_corr(df2.select_dtypes(include=np.number))
+# Correlation of the indicators on a contiguous float array, df2 is a
+# complete, filled country x indicator grid so it holds no NaN
+corr_values = np.corrcoef(df2[numeric_cols].to_numpy(np.float64),
+                          rowvar=False)
+correlation_map = pd.DataFrame(corr_values, index=numeric_cols,
+                               columns=numeric_cols)
+
+# Plot the correlation map
+fig = plt.figure(figsize=(10, 8))
+sns.heatmap(correlation_map, cmap='coolwarm', vmin=-1, vmax=1)
+plt.title('Correlation of Indicators', fontsize=15, fontweight='bold')
+fig.savefig(figure_path('correlation'), dpi=100)
+plt.close(fig)
 
 # Function to Cluster data 
-def cluster_data(df, n_clusters=4):
+def cluster_data(df, numeric_cols, n_clusters=4):
     """
     K-means clustering.
   
     Args:
       df: The dataframe to be clustered.
+      numeric_cols: The numeric columns to cluster on.
       n_clusters: The number of clusters to generate.
   
     Returns:
@@ -131,13 +172,22 @@ def cluster_data(df, n_clusters=4):
     cluster_df = df.copy()
   
     # Normalize data using the scaler function from cluster tools
-    normalized_data, data_min, data_max = scaler(cluster_df.select_dtypes(include=np.number))
+    normalized_data, data_min, data_max = scaler(cluster_df[numeric_cols])
     
-    # Create a KMeans model.
-    model = KMeans(n_clusters=n_clusters, random_state=0)
+    # Contiguous float32 array, KMeans has a native float32 path
+    data = np.ascontiguousarray(normalized_data, dtype=np.float32)
+
+    # Reject gaps and constant columns, which the scaler turns into 0/0
+    if not np.isfinite(data).all():
+        raise ValueError("cluster_data: normalized data contains NaN or inf")
+  
+    # Create a MiniBatchKMeans model, no reassignment for determinism
+    model = MiniBatchKMeans(n_clusters=n_clusters, random_state=0,
+                            batch_size=256, n_init=3, max_iter=100,
+                            reassignment_ratio=0)
   
     # Fit the model to the data.
-    model.fit(normalized_data)
+    model.fit(data)
     
     # Get the cluster labels.
     cluster_labels = model.labels_
@@ -147,7 +197,10 @@ def cluster_data(df, n_clusters=4):
     
     return cluster_df, normalized_data
     
-c_data, n_data = cluster_data(df2)
+c_data, n_data = cluster_data(df2, numeric_cols)
+
+# Set the style for the cluster plots
+sns.set_theme(style="darkgrid")
 
 # Function to visualize the relationship between clusters
 def visualize_clusters(clustered_data, cluster_column, indicators):
@@ -162,37 +215,45 @@ def visualize_clusters(clustered_data, cluster_column, indicators):
     Returns:
         None
     """
-    # Set the style for the plots
-    sns.set(style="darkgrid")
-
-    # Loop through each indicator to create visualizations
-    for indicator in indicators:
-        plt.figure(figsize=(12, 8))
+    # Function to create the visualization for one indicator
+    def render(indicator):
+        fig = Figure(figsize=(12, 8), dpi=100)
+        ax = fig.subplots()
         
         # Create a boxplot for each cluster
         sns.barplot(x=cluster_column, y=indicator, 
-                    data=clustered_data, errorbar=None)
+                    data=clustered_data, errorbar=None, ax=ax)
         
         # Set plot labels and title
-        title_text = indicator.split('(')[0]
-        plt.xlabel("Cluster", fontsize=14)
-        plt.ylabel(f"{title_text}", fontsize=14)
-        plt.title(f'Distribution of {title_text} across Clusters', 
-                  fontsize=16, fontweight='bold')
+        title_text = indicator_titles[indicator]
+        ax.set_xlabel("Cluster", fontsize=14)
+        ax.set_ylabel(f"{title_text}", fontsize=14)
+        ax.set_title(f'Distribution of {title_text} across Clusters', 
+                     fontsize=16, fontweight='bold')
         
-        # Show the plot
-        plt.show()
+        # Save the plot
+        FigureCanvasAgg(fig).print_png(figure_path(f'cluster {indicator}'))
+
+    # Render the indicators in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(render, indicators))
 
-        
-    
 
 visualize_clusters(c_data, "Cluster", indicator_list)
 
+# Last row of each cluster, found from a stable sort of the labels, which
+# matches groupby().last() since c_data holds no NaN (see cluster_data)
+cluster_labels = c_data['Cluster'].to_numpy()
+order = np.argsort(cluster_labels, kind='stable')
+last_idx = order[np.flatnonzero(np.diff(cluster_labels[order], append=-1) != 0)]
+g_data = c_data.iloc[last_idx].set_index('Cluster')
+
 # Compare Indicator Distribution in each cluster
-c_data.groupby('Cluster').last().plot(kind='bar', figsize=(12,8))
+ax = g_data.plot(kind='bar', figsize=(12,8))
 plt.title("Indicator Distribution Across CLusters")
 plt.ylabel("Value")
-plt.show()
+ax.figure.savefig(figure_path('cluster distribution'), dpi=100)
+plt.close(ax.figure)
 
 # Function to fit model
 def fit_model_with_errors(x, y, func, initial_guess=None, alpha=0.05):
@@ -216,29 +277,50 @@ def fit_model_with_errors(x, y, func, initial_guess=None, alpha=0.05):
         conf_int_low_ols: Lower bounds of confidence intervals for OLS.
         conf_int_high_ols: Upper bounds of confidence intervals for OLS.
     """
-    # Perform curve fitting
-    popt, pcov = curve_fit(func, x, y, p0=initial_guess)
+    x_values = np.asarray(x, dtype=np.float64)
+    y_values = np.asarray(y, dtype=np.float64)
+    n_obs = len(y_values)
+
+    # Ordinary Least Squares (OLS) design matrix
+    X_ols = np.column_stack([np.ones(n_obs), x_values])  # Add a constant term
+
+    # Fit the OLS model and generate its predictions
+    beta_ols = np.linalg.lstsq(X_ols, y_values, rcond=None)[0]
+    predictions_ols = X_ols @ beta_ols
+
+    # Covariance of the OLS parameters
+    residuals = y_values - predictions_ols
+    sigma2_ols = residuals @ residuals / (n_obs - 2)
+    cov_ols = sigma2_ols * np.linalg.inv(X_ols.T @ X_ols)
+
+    if func is linear_function:
+        # Same least-squares problem as OLS, parameters ordered as (a, b)
+        popt = beta_ols[::-1]
+        pcov = cov_ols[::-1, ::-1]
+
+        # Propagate errors with the analytical Jacobian, (x, 1) per point
+        jacobian = linear_jacobian(x_values, *popt)
+        sigma_curve_fit = np.sqrt(np.einsum('ij,jk,ik->i',
+                                            jacobian, pcov, jacobian))
+    else:
+        # Perform curve fitting
+        popt, pcov = curve_fit(func, x, y, p0=initial_guess)
+
+        # Calculate error ranges using error propagation for curve_fit
+        sigma_curve_fit = error_prop(x, func, popt, pcov)
 
     # Generate predictions using the fitted model (curve_fit)
     predictions_curve_fit = func(x, *popt)
 
-    # Ordinary Least Squares (OLS) model
-    X_ols = sm.add_constant(x)  # Add a constant term
-    model_ols = sm.OLS(y, X_ols).fit()
-
-    # Generate predictions using OLS model
-    predictions_ols = model_ols.predict(X_ols)
-
-    # Calculate error ranges using error propagation for curve_fit
-    sigma_curve_fit = error_prop(x, func, popt, pcov)
-
     # Calculate confidence intervals for curve_fit
     lowerbound_curve_fit = predictions_curve_fit - sigma_curve_fit
     upperbound_curve_fit = predictions_curve_fit + sigma_curve_fit
 
-    # Calculate confidence intervals for OLS
-    conf_int_ols = model_ols.get_prediction(X_ols).conf_int(alpha=alpha)
-    lowerbound_ols, upperbound_ols = conf_int_ols[:, 0], conf_int_ols[:, 1]
+    # Calculate confidence intervals for the OLS mean prediction
+    se_ols = np.sqrt(np.einsum('ij,jk,ik->i', X_ols, cov_ols, X_ols))
+    t_quantile = stats.t.ppf(1 - alpha / 2, n_obs - 2)
+    lowerbound_ols = predictions_ols - t_quantile * se_ols
+    upperbound_ols = predictions_ols + t_quantile * se_ols
 
     return popt, pcov, predictions_curve_fit, predictions_ols, \
            lowerbound_curve_fit, upperbound_curve_fit, \
@@ -248,9 +330,18 @@ def fit_model_with_errors(x, y, func, initial_guess=None, alpha=0.05):
 def linear_function(x, a, b):
     return a * x + b
 
+# Jacobian of linear_function with respect to (a, b)
+def linear_jacobian(x, a, b):
+    return np.stack([x, np.ones_like(x)], axis=1)
+
 # Implementation
-x_data = df2[('Year')].astype('int')
-y_data = df2['CO2 emissions (kg per PPP $ of GDP)']
+x_data = np.ascontiguousarray(df2['Year'].astype(np.int32).to_numpy())
+y_data = np.ascontiguousarray(
+    df2['CO2 emissions (kg per PPP $ of GDP)'].to_numpy(dtype=np.float64))
+
+# Drop missing observations once, before fitting
+valid = ~np.isnan(y_data)
+x_data, y_data = x_data[valid], y_data[valid]
 
 # Fit the model with error propagation
 optimal_params, covariance_matrix, \
@@ -261,6 +352,7 @@ optimal_params, covariance_matrix, \
                 upper_bound = fit_model_with_errors(x_data, y_data, linear_function)
 
 # Plot the results
+fig = plt.figure()
 sns.lineplot(x=x_data, y=y_data, label='Original Data', color='blue')
 sns.lineplot(x=x_data, y=predictions_ols, label='OLS Predictions', color='red')
 plt.fill_between(x_data, lower_bound, upper_bound, 
@@ -268,6 +360,5 @@ plt.fill_between(x_data, lower_bound, upper_bound,
 plt.xlabel('Year')
 plt.ylabel('CO2 emissions (kg per PPP $ of GDP)')
 plt.legend()
-plt.show()
-
-g_data = c_data.groupby('Cluster').last()
+fig.savefig(figure_path('co2 fit'), dpi=100)
+plt.close(fig)